@@ -3,8 +3,16 @@ import os
 from pathlib import Path
 from dotenv import load_dotenv
 import asyncio
+import gc
 import json
+import resource
+import sys
+import tempfile
+import tracemalloc
+import weakref
 import aiohttp
+from collections import deque
+from dataclasses import asdict, dataclass, field
 from typing import Optional
 
 # Resolve the directory containing this file (works reliably in containers)
@@ -18,10 +26,12 @@ from livekit.agents import (
     cli,
     function_tool,
     RunContext,
+    SpeechCreatedEvent,
     room_io,
     utils,
     ToolError
 )
+from livekit.agents.voice import SpeechHandle
 from livekit.plugins import noise_cancellation, openai, silero
 from livekit.plugins.turn_detector.multilingual import MultilingualModel
 
@@ -31,6 +41,329 @@ logger = logging.getLogger("agent")
 load_dotenv(SCRIPT_DIR.parent / ".env.local")
 
 
+@dataclass
+class PreemptiveGenerationStats:
+    """Counts how often a speculative reply was kept versus thrown away."""
+
+    started: int = 0
+    kept: int = 0
+    discarded: int = 0
+
+
+def track_preemptive_generation(session: AgentSession) -> PreemptiveGenerationStats:
+    """
+    Attach counters for preemptive generation to the session.
+
+    A normal reply is scheduled synchronously while it is created, whereas a
+    preemptive reply is held back until end-of-turn is confirmed. A reply that
+    is still unscheduled once creation returns is therefore speculative; it was
+    kept if it got scheduled before finishing, and discarded otherwise.
+    """
+    stats = PreemptiveGenerationStats()
+
+    def _on_done(handle: SpeechHandle) -> None:
+        if handle.scheduled:
+            stats.kept += 1
+        else:
+            stats.discarded += 1
+
+    def _check_speculative(handle: SpeechHandle) -> None:
+        if handle.scheduled or handle.done():
+            return
+        stats.started += 1
+        handle.add_done_callback(_on_done)
+
+    @session.on("speech_created")
+    def _on_speech_created(ev: SpeechCreatedEvent) -> None:
+        if ev.source != "generate_reply":
+            return
+        asyncio.get_running_loop().call_soon(_check_speculative, ev.speech_handle)
+
+    return stats
+
+
+# Set MEMORY_PROFILING=1 to attribute memory growth with tracemalloc (slow)
+MEMORY_PROFILING = os.getenv("MEMORY_PROFILING", "").lower() in ("1", "true", "yes")
+MEMORY_SAMPLE_INTERVAL = 5.0
+MEMORY_SUMMARY_INTERVAL = 60.0
+MEMORY_LEAK_THRESHOLD = 10 * 1024 * 1024
+# Job processes write their reports here and the worker process collects them
+MEMORY_REPORT_DIR_ENV = "AGENT_MEMORY_REPORT_DIR"
+
+_memory_reports: "deque[MemoryReport]" = deque(maxlen=1000)
+_worker_memory_task: Optional[asyncio.Task] = None
+
+
+def _current_rss() -> Optional[int]:
+    """Resident set size of this process in bytes, or None if /proc is unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _peak_rss() -> int:
+    """Peak resident set size of this process in bytes."""
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+def _subsystem(filename: str) -> str:
+    """Group an allocation site by package, e.g. livekit.plugins.silero or aiohttp."""
+    parts = Path(filename).parts
+    if "site-packages" not in parts:
+        return Path(filename).stem
+    parts = parts[parts.index("site-packages") + 1 :]
+    depth = 3 if parts[0] == "livekit" else 1
+    return ".".join(parts[:depth]).removesuffix(".py")
+
+
+@dataclass
+class MemoryReport:
+    """
+    Memory used by one job, from job start until after its session closed.
+
+    Where only the peak RSS is available, rss_start is the peak at job start
+    and rss_end and retained are left as None.
+    """
+
+    job_id: str
+    rss_start: int
+    rss_peak: int
+    rss_end: Optional[int] = None
+    traced_growth: dict[str, int] = field(default_factory=dict)
+    unreleased: list[str] = field(default_factory=list)
+    leaked: Optional[bool] = None
+
+    @property
+    def growth(self) -> int:
+        return self.rss_peak - self.rss_start
+
+    @property
+    def retained(self) -> Optional[int]:
+        if self.rss_end is None:
+            return None
+        return self.rss_end - self.rss_start
+
+
+@dataclass
+class WorkerMemoryStats:
+    """
+    Memory figures across the jobs run by this worker.
+
+    Each job normally runs in its own process, so a call costs the whole
+    process: the prewarmed baseline (livekit, onnxruntime, plugins) plus the
+    job's growth. Use max_peak, the highest absolute RSS of a job, when deciding
+    how many concurrent calls fit on a node. The growth figures only show what
+    the call itself added on top of that baseline.
+    """
+
+    jobs: int
+    avg_peak: float
+    max_peak: int
+    avg_growth: float
+    max_growth: int
+    leaked_jobs: int
+
+
+def collect_memory_reports() -> None:
+    """Move reports written by job processes into this worker's totals."""
+    report_dir = os.getenv(MEMORY_REPORT_DIR_ENV)
+    if not report_dir:
+        return
+
+    for path in sorted(Path(report_dir).glob("*.json")):
+        try:
+            _memory_reports.append(MemoryReport(**json.loads(path.read_text())))
+        except (OSError, ValueError, TypeError):
+            logger.warning(f"skipping unreadable memory report {path.name}")
+        path.unlink(missing_ok=True)
+
+
+def worker_memory_per_session() -> Optional[WorkerMemoryStats]:
+    """Per-job memory figures across the jobs run by this worker."""
+    collect_memory_reports()
+    if not _memory_reports:
+        return None
+
+    jobs = len(_memory_reports)
+    return WorkerMemoryStats(
+        jobs=jobs,
+        avg_peak=sum(r.rss_peak for r in _memory_reports) / jobs,
+        max_peak=max(r.rss_peak for r in _memory_reports),
+        avg_growth=sum(r.growth for r in _memory_reports) / jobs,
+        max_growth=max(r.growth for r in _memory_reports),
+        leaked_jobs=sum(1 for r in _memory_reports if r.leaked),
+    )
+
+
+async def _log_worker_memory() -> None:
+    mb = 1024 * 1024
+    logged = 0
+    while True:
+        await asyncio.sleep(MEMORY_SUMMARY_INTERVAL)
+        stats = worker_memory_per_session()
+        if stats is None or stats.jobs == logged:
+            continue
+        logged = stats.jobs
+        logger.info(
+            f"worker memory: avg_peak={stats.avg_peak / mb:.1f}MB "
+            f"max_peak={stats.max_peak / mb:.1f}MB "
+            f"avg_growth={stats.avg_growth / mb:.1f}MB "
+            f"max_growth={stats.max_growth / mb:.1f}MB "
+            f"leaked_jobs={stats.leaked_jobs} "
+            f"jobs={stats.jobs}"
+        )
+
+
+class MemoryTracker:
+    """
+    Snapshots memory at job start and again once the job's session has closed.
+
+    RSS is sampled while the job runs to find its peak. The report is written
+    to the directory named by AGENT_MEMORY_REPORT_DIR, where the worker process
+    collects it, because each job normally runs in its own short-lived process.
+
+    A job is flagged as leaked when the parts the session drops on close (its
+    activity and room IO) are still alive afterwards, or when MEMORY_PROFILING
+    is set and the traced growth exceeds MEMORY_LEAK_THRESHOLD. RSS alone is
+    never used, as freed memory is rarely returned to the OS.
+
+    Under the thread executor (e.g. `console` mode) concurrent jobs share one
+    process, so growth and traced_growth also include allocations made by the
+    other calls running at the same time.
+    """
+
+    def __init__(self, job_id: str) -> None:
+        self.job_id = job_id
+        self._rss_start = 0
+        self._rss_peak = 0
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._session: Optional[weakref.ref[AgentSession]] = None
+        self._sampler: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        gc.collect()
+        rss = _current_rss()
+        self._rss_start = self._rss_peak = rss if rss is not None else _peak_rss()
+        if MEMORY_PROFILING:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self._snapshot = tracemalloc.take_snapshot()
+        if rss is not None:
+            self._sampler = asyncio.create_task(self._sample_rss())
+
+    def track_session(self, session: AgentSession) -> None:
+        self._session = weakref.ref(session)
+
+    async def _sample_rss(self) -> None:
+        while True:
+            self._rss_peak = max(self._rss_peak, _current_rss() or 0)
+            await asyncio.sleep(MEMORY_SAMPLE_INTERVAL)
+
+    async def _close_session(self) -> dict[str, "weakref.ref[object]"]:
+        session = self._session() if self._session is not None else None
+        if session is None:
+            return {}
+
+        # the JobContext keeps its primary session until the process exits, so
+        # check the parts the session itself drops on close
+        parts = {
+            name: weakref.ref(obj)
+            for name, obj in (
+                ("activity", session._activity),
+                ("room_io", session._room_io),
+            )
+            if obj is not None
+        }
+        # shutdown callbacks run concurrently, so make sure the session has
+        # closed (a no-op if it already has) before measuring
+        await session.aclose()
+        return parts
+
+    async def stop(self) -> MemoryReport:
+        if self._sampler is not None:
+            await utils.aio.cancel_and_wait(self._sampler)
+
+        parts = await self._close_session()
+        gc.collect()
+
+        rss_end = _current_rss()
+        report = MemoryReport(
+            job_id=self.job_id,
+            rss_start=self._rss_start,
+            rss_peak=max(self._rss_peak, rss_end or _peak_rss()),
+            rss_end=rss_end,
+            unreleased=[name for name, ref in parts.items() if ref() is not None],
+        )
+        if parts:
+            report.leaked = bool(report.unreleased)
+
+        if self._snapshot is not None:
+            growth: dict[str, int] = {}
+            diff = tracemalloc.take_snapshot().compare_to(self._snapshot, "filename")
+            for stat in diff:
+                name = _subsystem(stat.traceback[0].filename)
+                growth[name] = growth.get(name, 0) + stat.size_diff
+            report.traced_growth = {
+                name: size
+                for name, size in sorted(growth.items(), key=lambda i: -i[1])
+                if size > 0
+            }
+            # the shared HTTP session's connection pool is only closed by the
+            # framework after all shutdown callbacks, so it is still open here
+            held = sum(
+                size for name, size in report.traced_growth.items() if name != "aiohttp"
+            )
+            report.leaked = bool(report.leaked) or held > MEMORY_LEAK_THRESHOLD
+            self._snapshot = None
+
+        self._log(report)
+        self._publish(report)
+        return report
+
+    def _publish(self, report: MemoryReport) -> None:
+        report_dir = os.getenv(MEMORY_REPORT_DIR_ENV)
+        if not report_dir:
+            return
+
+        path = Path(report_dir) / f"{self.job_id}.json"
+        tmp_path = path.with_suffix(".tmp")
+        try:
+            tmp_path.write_text(json.dumps(asdict(report)))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"failed to write memory report: {e!s}")
+
+    def _log(self, report: MemoryReport) -> None:
+        mb = 1024 * 1024
+        retained = (
+            f"{report.retained / mb:.1f}MB" if report.retained is not None else "unknown"
+        )
+        logger.info(
+            f"job memory: peak={report.rss_peak / mb:.1f}MB "
+            f"growth={report.growth / mb:.1f}MB "
+            f"retained={retained}",
+            extra={"traced_growth": report.traced_growth},
+        )
+        if report.leaked:
+            logger.warning(
+                "memory allocated during the job was not released after the session closed",
+                extra={
+                    "unreleased": report.unreleased,
+                    "traced_growth": report.traced_growth,
+                },
+            )
+
+
+def _is_speculative(context: RunContext) -> bool:
+    # tools run on the reply's speech handle, which is only scheduled once the
+    # user's turn is confirmed
+    return not context.speech_handle.scheduled
+
+
 class Assistant(Agent):
     def __init__(self) -> None:
         # Load the prompt from ai_prompt.md
@@ -122,6 +455,9 @@ class Assistant(Agent):
             interest_ev: Whether the customer plans to get an EV
             date_time: Preferred date and time for the consultation in ISO 8601 format
         """
+        if _is_speculative(context):
+            raise ToolError("error: cannot save lead before the user's turn is complete")
+
         context.disallow_interruptions()
 
         url = "https://kcalvin.myvnc.com/webhook/save_lead"
@@ -165,6 +501,9 @@ class Assistant(Agent):
         Args:
             reason: Optional reason for ending the call (e.g., "user requested", "consultation booked", "not interested")
         """
+        if _is_speculative(context):
+            raise ToolError("error: cannot end call before the user's turn is complete")
+
         logger.info(f"Ending call. Reason: {reason or 'No reason provided'}")
         
         # Shutdown the session gracefully, allowing any pending speech to complete
@@ -190,18 +529,39 @@ async def my_agent(ctx: JobContext):
         "room": ctx.room.name,
     }
 
+    memory_tracker = MemoryTracker(ctx.job.id)
+    memory_tracker.start()
+    ctx.add_shutdown_callback(memory_tracker.stop)
+
     # Set up the session with OpenAI Realtime Model
     session = AgentSession(
         llm="google/gemini-2.5-flash",
         stt="deepgram/nova-2",
         tts="deepgram/aura-2:athena",
         vad=silero.VAD.load(),
-            
+        # Start the LLM on stable STT segments before end-of-turn is confirmed.
+        # Audio is held back until the turn ends, and the reply is regenerated
+        # if the final transcript differs.
+        preemptive_generation=True,
+
         # llm=openai.realtime.RealtimeModel(
         #     voice="ballad",
         # )
     )
 
+    memory_tracker.track_session(session)
+    preemptive_stats = track_preemptive_generation(session)
+
+    async def log_preemptive_stats():
+        logger.info(
+            "preemptive generation: "
+            f"started={preemptive_stats.started} "
+            f"kept={preemptive_stats.kept} "
+            f"discarded={preemptive_stats.discarded}"
+        )
+
+    ctx.add_shutdown_callback(log_preemptive_stats)
+
     # Start the session, which initializes the voice pipeline and warms up the models
     await session.start(
         agent=Assistant(),
@@ -222,5 +582,14 @@ async def my_agent(ctx: JobContext):
     await ctx.connect()
 
 
+@server.on("worker_started")
+def _on_worker_started():
+    global _worker_memory_task
+    _worker_memory_task = asyncio.create_task(_log_worker_memory())
+
+
 if __name__ == "__main__":
+    # set before job processes start so they inherit it
+    if MEMORY_REPORT_DIR_ENV not in os.environ:
+        os.environ[MEMORY_REPORT_DIR_ENV] = tempfile.mkdtemp(prefix="agent-memory-")
     cli.run_app(server)
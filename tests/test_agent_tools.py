@@ -1,13 +1,26 @@
+import asyncio
+import gc
 import pytest
-from unittest.mock import AsyncMock, MagicMock, patch
+import tracemalloc
+import weakref
+from unittest.mock import AsyncMock, MagicMock, PropertyMock, patch
 import sys
 import os
 
 # Ensure src is in path for imports
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
 
-from agent import Assistant
-from livekit.agents import ToolError
+import agent as agent_module
+from agent import (
+    Assistant,
+    MemoryTracker,
+    PreemptiveGenerationStats,
+    _subsystem,
+    track_preemptive_generation,
+    worker_memory_per_session,
+)
+from livekit.agents import SpeechCreatedEvent, ToolError, utils
+from livekit.agents.voice import SpeechHandle
 
 @pytest.fixture
 def agent():
@@ -110,3 +123,179 @@ async def test_save_lead(agent, run_context):
     args, kwargs = mock_session.post.call_args
     assert kwargs["json"] == expected_payload
     assert str(args[0]) == "https://kcalvin.myvnc.com/webhook-test/save_lead"
+
+@pytest.mark.asyncio
+async def test_save_lead_refused_while_speculative(agent, run_context):
+    run_context.speech_handle.scheduled = False
+    mock_session = MagicMock()
+
+    with patch("livekit.agents.utils.http_context.http_session", return_value=mock_session):
+        with pytest.raises(ToolError):
+            await agent._http_tool_save_lead(
+                run_context, "John Doe", "5551234567", "john@example.com", "123 Solar St", "Sunville", "CA", "90000", "Metal", "200", True, False, "2026-02-10T14:00:00-05:00"
+            )
+
+    mock_session.post.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_end_call_refused_while_speculative(agent, run_context):
+    run_context.speech_handle.scheduled = False
+
+    with patch.object(Assistant, "session", new_callable=PropertyMock) as mock_session:
+        with pytest.raises(ToolError):
+            await agent._end_call(run_context, "user requested")
+
+    mock_session.return_value.shutdown.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_track_preemptive_generation():
+    session = utils.EventEmitter()
+    stats = track_preemptive_generation(session)
+
+    def create_reply():
+        handle = SpeechHandle.create()
+        session.emit(
+            "speech_created",
+            SpeechCreatedEvent(speech_handle=handle, user_initiated=True, source="generate_reply"),
+        )
+        return handle
+
+    # a regular reply is scheduled as soon as it is created
+    regular = create_reply()
+    regular._mark_scheduled()
+    # a preemptive reply confirmed at end-of-turn
+    kept = create_reply()
+    # a preemptive reply invalidated by a different final transcript
+    discarded = create_reply()
+    await asyncio.sleep(0)
+
+    kept._mark_scheduled()
+    for handle in (regular, kept, discarded):
+        handle._mark_done()
+    await asyncio.sleep(0)
+
+    assert stats == PreemptiveGenerationStats(started=2, kept=1, discarded=1)
+
+class _FakeActivity:
+    def __init__(self):
+        self.buffers = [bytearray(1024) for _ in range(20 * 1024)]
+
+class _FakeSession:
+    """Stands in for an AgentSession whose activity holds audio buffers until close."""
+
+    def __init__(self, keep_buffers=False):
+        self._activity = _FakeActivity()
+        self._room_io = None
+        self.history = []
+        self.keep_buffers = keep_buffers
+        self.closed = False
+
+    async def aclose(self):
+        self.closed = True
+        if self.keep_buffers:
+            self.history.append(self._activity.buffers)
+        self._activity = None
+
+@pytest.fixture
+def memory_env(monkeypatch, tmp_path):
+    monkeypatch.setenv(agent_module.MEMORY_REPORT_DIR_ENV, str(tmp_path))
+    agent_module._memory_reports.clear()
+    was_tracing = tracemalloc.is_tracing()
+    yield tmp_path
+    agent_module._memory_reports.clear()
+    if not was_tracing:
+        tracemalloc.stop()
+
+@pytest.mark.asyncio
+async def test_memory_tracker_measures_after_session_close(memory_env, monkeypatch):
+    monkeypatch.setattr(agent_module, "MEMORY_PROFILING", True)
+    tracker = MemoryTracker("job-single")
+    tracker.start()
+    # the job context keeps its session referenced while shutdown callbacks run
+    session = _FakeSession()
+    tracker.track_session(session)
+
+    report = await tracker.stop()
+
+    assert session.closed
+    assert report.unreleased == []
+    assert report.leaked is False
+    assert report.rss_peak >= report.rss_start
+    assert report.retained is not None
+
+    # the worker process picks up the report written by the job process
+    stats = worker_memory_per_session()
+    assert stats.jobs == 1
+    assert stats.max_peak == report.rss_peak
+    assert stats.avg_growth == report.growth
+    assert list(memory_env.glob("*.json")) == []
+
+def test_memory_tracker_holds_session_weakly():
+    tracker = MemoryTracker("job-weak")
+    session = _FakeSession()
+    ref = weakref.ref(session)
+    tracker.track_session(session)
+
+    del session
+    gc.collect()
+
+    assert ref() is None
+
+@pytest.mark.asyncio
+async def test_memory_tracker_flags_unreleased_activity(memory_env):
+    tracker = MemoryTracker("job-activity")
+    tracker.start()
+    session = _FakeSession()
+    tracker.track_session(session)
+    held = session._activity
+
+    report = await tracker.stop()
+
+    assert held is not None
+    assert report.unreleased == ["activity"]
+    assert report.leaked is True
+
+@pytest.mark.asyncio
+async def test_memory_tracker_flags_traced_growth(memory_env, monkeypatch):
+    monkeypatch.setattr(agent_module, "MEMORY_PROFILING", True)
+    tracker = MemoryTracker("job-buffers")
+    tracker.start()
+    session = _FakeSession(keep_buffers=True)
+    tracker.track_session(session)
+
+    report = await tracker.stop()
+
+    assert report.unreleased == []
+    assert report.leaked is True
+    assert sum(report.traced_growth.values()) > agent_module.MEMORY_LEAK_THRESHOLD
+
+@pytest.mark.asyncio
+async def test_memory_tracker_rss_alone_never_flags_leak(memory_env):
+    tracker = MemoryTracker("job-rss-only")
+    tracker.start()
+    retained = [bytearray(1024) for _ in range(20 * 1024)]
+
+    report = await tracker.stop()
+
+    assert retained
+    assert report.retained is not None
+    assert report.leaked is None
+
+@pytest.mark.asyncio
+async def test_memory_tracker_without_current_rss(memory_env, monkeypatch):
+    monkeypatch.setattr(agent_module, "_current_rss", lambda: None)
+    tracker = MemoryTracker("job-peak-only")
+    tracker.start()
+
+    report = await tracker.stop()
+
+    assert report.rss_end is None
+    assert report.retained is None
+    assert report.leaked is None
+    assert report.growth >= 0
+
+def test_subsystem():
+    assert _subsystem("/usr/lib/python3.11/site-packages/livekit/plugins/silero/vad.py") == "livekit.plugins.silero"
+    assert _subsystem("/usr/lib/python3.11/site-packages/livekit/agents/voice/agent_session.py") == "livekit.agents.voice"
+    assert _subsystem("/usr/lib/python3.11/site-packages/aiohttp/client.py") == "aiohttp"
+    assert _subsystem("/app/src/agent.py") == "agent"